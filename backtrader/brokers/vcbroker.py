@@ -30,10 +30,13 @@ from backtrader.comminfo import CommInfoBase
 from backtrader.feed import DataBase
 from backtrader.metabase import MetaParams
 from backtrader.position import Position
-from backtrader.utils.py3 import with_metaclass
+from backtrader.utils.py3 import queue, with_metaclass
 
 from backtrader.stores import vcstore
 
+# C-implemented unbounded queue (Python >= 3.7), fallback to the regular one
+_SimpleQueue = getattr(queue, 'SimpleQueue', queue.Queue)
+
 
 class VCCommInfo(CommInfoBase):
     '''
@@ -59,6 +62,19 @@ class VCCommInfo(CommInfoBase):
         return abs(size) * price
 
 
+def _setprice_limit(vcorder, price, plimit):
+    vcorder.Price = price or plimit  # cover naming confusion cases
+
+
+def _setprice_stop(vcorder, price, plimit):
+    vcorder.StopPrice = price
+
+
+def _setprice_stoplimit(vcorder, price, plimit):
+    vcorder.StopPrice = price
+    vcorder.Price = plimit
+
+
 class MetaVCBroker(BrokerBase.__class__):
     def __init__(cls, name, bases, dct):
         '''Class has already been created ... register'''
@@ -128,6 +144,28 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
         ('commission', None),
     )
 
+    _POS_SHARDS = 16  # number of position shards (must be a power of 2)
+    _VCORDER_POOL = 32  # max ComTrader order objects kept for reuse
+    _SUBMIT_TMOUT = 10.0  # secs to wait in stop for queued orders to be sent
+    _maps_built = False  # order mapping dicts built by _build_maps
+
+    # Fields of the ComTrader order assigned in _makeorder. They are instance
+    # attributes of the COM object and not reported by dir on a fresh one
+    _VCORDER_FIELDS = (
+        'Account', 'SymbolCode', 'OrderType', 'OrderSide',
+        'VolumeRestriction', 'HideVolume', 'MinVolume', 'UserOrderId',
+        'ExtendedInfo', 'Volume', 'StopPrice', 'Price', 'ValidDate',
+        'TimeRestriction',
+    )
+
+    # Price setters for the ComTrader order by exectype. Market and Close
+    # orders carry no price
+    _PRICE_SETTERS = {
+        Order.Limit: _setprice_limit,
+        Order.Stop: _setprice_stop,
+        Order.StopLimit: _setprice_stoplimit,
+    }
+
     def __init__(self, **kwargs):
         super(VCBroker, self).__init__()
 
@@ -135,57 +173,110 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
 
         # Account data
         self._acc_name = None
+        self._acc_obj = None  # ComTrader account object (broker thread)
         self.startingcash = self.cash = 0.0
         self.startingvalue = self.value = 0.0
 
-        # Position accounting
-        self._lock_pos = threading.Lock()  # sync account updates
-        self.positions = collections.defaultdict(Position)  # actual positions
+        # Commission schemes already resolved per tradename
+        self._comminfo_cache = dict()
+
+        # Position accounting, sharded by tradename. Each shard has its own
+        # lock to let lookups on different symbols proceed without contention
+        self._pos_shards = [
+            (threading.Lock(), collections.defaultdict(Position))
+            for _ in range(self._POS_SHARDS)
+        ]
 
         # Order storage
-        self._lock_orders = threading.Lock()  # control access
+        # Only insertions are done under the lock. Lookups from the COM event
+        # callbacks rely on single dict operations being atomic under the GIL
+        # and are done lock-free. A free-threaded interpreter would need a
+        # (narrow) locked section around the lookups too
+        self._lock_orders = threading.Lock()  # control insertions
         self.orderbyid = dict()  # orders by order id
+        self._submit_q = queue.Queue()  # orders pending to be sent
+        self._t_submitter = None  # thread sending the orders (if connected)
+        self._submitting = False  # orders can be sent by the thread
+
+        # Reusable ComTrader order objects (per thread)
+        self._order_pool = threading.local()
+        self._order_fields = frozenset()  # filled in start
 
-        # Notifications
-        self.notifs = collections.deque()
+        # Wall clock time taken once per next, ComTrader only uses the date
+        self._now = None
+
+        # Notifications (put from the COM thread, get from the main thread)
+        self.notifs = _SimpleQueue()
 
         # Dictionaries of values for order mapping
-        self._otypes = {
-            Order.Market: self.store.vcctmod.OT_Market,
-            Order.Close: self.store.vcctmod.OT_Market,
-            Order.Limit: self.store.vcctmod.OT_Limit,
-            Order.Stop: self.store.vcctmod.OT_StopMarket,
-            Order.StopLimit: self.store.vcctmod.OT_StopLimit,
+        self._build_maps(self.store)
+
+    @classmethod
+    def _build_maps(cls, store):
+        # The mappings depend only on the COM modules of the (singleton) store
+        # and are therefore built once and shared by all instances
+        if cls._maps_built:
+            return
+
+        vcctmod, vcdsmod = store.vcctmod, store.vcdsmod
+        cls._otypes = {
+            Order.Market: vcctmod.OT_Market,
+            Order.Close: vcctmod.OT_Market,
+            Order.Limit: vcctmod.OT_Limit,
+            Order.Stop: vcctmod.OT_StopMarket,
+            Order.StopLimit: vcctmod.OT_StopLimit,
         }
 
-        self._osides = {
-            Order.Buy: self.store.vcctmod.OS_Buy,
-            Order.Sell: self.store.vcctmod.OS_Sell,
+        cls._osides = {
+            Order.Buy: vcctmod.OS_Buy,
+            Order.Sell: vcctmod.OS_Sell,
         }
 
-        self._otrestriction = {
-            Order.T_None: self.store.vcctmod.TR_NoRestriction,
-            Order.T_Date: self.store.vcctmod.TR_Date,
-            Order.T_Close: self.store.vcctmod.TR_CloseAuction,
-            Order.T_Day: self.store.vcctmod.TR_Session,
+        cls._otrestriction = {
+            Order.T_None: vcctmod.TR_NoRestriction,
+            Order.T_Date: vcctmod.TR_Date,
+            Order.T_Close: vcctmod.TR_CloseAuction,
+            Order.T_Day: vcctmod.TR_Session,
         }
 
-        self._ovrestriction = {
-            Order.V_None: self.store.vcctmod.VR_NoRestriction,
+        cls._ovrestriction = {
+            Order.V_None: vcctmod.VR_NoRestriction,
         }
 
-        self._futlikes = (
-            self.store.vcdsmod.IT_Future, self.store.vcdsmod.IT_Option,
-            self.store.vcdsmod.IT_Fund,
-        )
+        cls._futlikes = frozenset((
+            vcdsmod.IT_Future, vcdsmod.IT_Option, vcdsmod.IT_Fund,
+        ))
+
+        cls._maps_built = True
 
     def start(self):
         super(VCBroker, self).start()
+        self._comminfo_cache.clear()  # comminfo may have been rebound/edited
         self.store.start(broker=self)
 
+        if self.store.connected():
+            # Names known to be settable in ComTrader orders by user
+            # arguments. The object used to find them is kept for reuse
+            vcorder = self.store.vcctmod.Order()
+            self._order_fields = frozenset(
+                x for x in dir(vcorder) if not x.startswith('_')).union(
+                    self._VCORDER_FIELDS)
+            self._return_vcorder(vcorder)
+
+            self._submitting = True
+            self._t_submitter = t = threading.Thread(target=self._t_submit)
+            t.daemon = True  # Do not stop a general exit
+            t.start()
+
     def stop(self):
         super(VCBroker, self).stop()
         self.store.stop()
+        self._submitting = False  # reject any further order
+        if self._t_submitter is not None:
+            # Let the orders already notified as submitted be sent
+            self._submit_q.put(None)  # stop the submission thread
+            self._t_submitter.join(self._SUBMIT_TMOUT)
+            self._t_submitter = None
 
     def getcash(self):
         # This call cannot block if no answer is available from ib
@@ -195,40 +286,75 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
         return self.value
 
     def get_notification(self):
-        return self.notifs.popleft()  # at leat a None is present
+        try:
+            return self.notifs.get(False)
+        except queue.Empty:
+            pass
+
+        return None
 
     def notify(self, order):
-        self.notifs.append(order.clone())
+        # The clone is needed: the order keeps being updated by the COM thread
+        # (further executions, completion) before the notification is read
+        self.notifs.put(order.clone())
 
     def next(self):
-        self.notifs.append(None)  # mark notificatino boundary
+        self._now = datetime.now()  # reference for relative validities
+        self.notifs.put(None)  # mark notificatino boundary
+
+    @property
+    def positions(self):
+        '''Merged view of the position shards, keyed by tradename'''
+        positions = collections.defaultdict(Position)
+        for lock, shard in self._pos_shards:
+            with lock:
+                positions.update(shard)
+
+        return positions
 
     def getposition(self, data, clone=True):
-        with self._lock_pos:
-            pos = self.positions[data._tradename]
-            if clone:
-                return pos.clone()
+        tradename = data._tradename
+        lock, positions = self._pos_shards[hash(tradename) &
+                                           (self._POS_SHARDS - 1)]
+        with lock:
+            pos = positions[tradename]
 
-        return pos
+        return pos.clone() if clone else pos
 
-    def getcommissioninfo(self, data):
-        if data._tradename in self.comminfo:
-            return self.comminfo[data._tradename]
+    def setcommission(self, *args, **kwargs):
+        self._comminfo_cache.clear()  # schemes may change
+        super(VCBroker, self).setcommission(*args, **kwargs)
+
+    def addcommissioninfo(self, comminfo, name=None):
+        self._comminfo_cache.clear()  # schemes may change
+        super(VCBroker, self).addcommissioninfo(comminfo, name=name)
 
-        comminfo = self.comminfo[None]
+    def getcommissioninfo(self, data):
+        tradename = data._tradename
+        comminfo = self._comminfo_cache.get(tradename)
         if comminfo is not None:
             return comminfo
 
-        stocklike = data._syminfo.Type in self._futlikes
+        if tradename in self.comminfo:
+            comminfo = self.comminfo[tradename]
+        else:
+            comminfo = self.comminfo[None]
+            if comminfo is None:
+                stocklike = data._syminfo.Type in self._futlikes
+                comminfo = VCCommInfo(mult=data._syminfo.PointValue,
+                                      stocklike=stocklike)
 
-        return VCCommInfo(mult=data._syminfo.PointValue, stocklike=stocklike)
+        self._comminfo_cache[tradename] = comminfo
+        return comminfo
 
     def _makeorder(self, ordtype, owner, data,
                    size, price=None, plimit=None,
                    exectype=None, valid=None,
                    tradeid=0, **kwargs):
 
-        order = self.store.vcctmod.Order()
+        # All fields used in SendOrder are (re)initialized below
+        pool = getattr(self._order_pool, 'pool', None)
+        order = pool.pop() if pool else self.store.vcctmod.Order()
         order.Account = self._acc_name
         order.SymbolCode = data._tradename
         order.OrderType = self._otypes[exectype]
@@ -246,65 +372,118 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
         else:
             order.ExtendedInfo = ''
 
-        order.Volume = abs(size)
+        order.Volume = -size if size < 0 else size
 
         order.StopPrice = 0.0
         order.Price = 0.0
-        if exectype == Order.Market:
-            pass
-        elif exectype == Order.Limit:
-            order.Price = price or plimit  # cover naming confusion cases
-        elif exectype == Order.Close:
-            pass
-        elif exectype == Order.Stop:
-            order.StopPrice = price
-        elif exectype == Order.StopLimit:
-            order.StopPrice = price
-            order.Price = plimit
+        setprice = self._PRICE_SETTERS.get(exectype)
+        if setprice is not None:
+            setprice(order, price, plimit)
 
+        # Common cases (Close or no validity) go first
         order.ValidDate = None
         if exectype == Order.Close:
             order.TimeRestriction = self._otrestriction[Order.T_Close]
-        else:
-            if valid is None:
-                order.TimeRestriction = self._otrestriction[Order.T_None]
-            elif isinstance(valid, (datetime, date)):
-                order.TimeRestriction = self._otrestriction[Order.T_Date]
-                order.ValidDate = valid
-            elif isinstance(valid, (timedelta,)):
-                if valid == Order.DAY:
-                    order.TimeRestriction = self._otrestriction[Order.T_Day]
-                else:
-                    order.TimeRestriction = self._otrestriction[Order.T_Date]
-                    order.ValidDate = datetime.now() + valid
-
-            elif not self.valid:  # DAY
+        elif valid is None:
+            order.TimeRestriction = self._otrestriction[Order.T_None]
+        elif isinstance(valid, (datetime, date)):
+            order.TimeRestriction = self._otrestriction[Order.T_Date]
+            order.ValidDate = valid
+        elif isinstance(valid, (timedelta,)):
+            if valid == Order.DAY:
                 order.TimeRestriction = self._otrestriction[Order.T_Day]
+            else:
+                order.TimeRestriction = self._otrestriction[Order.T_Date]
+                now = self._now or datetime.now()  # None before next
+                order.ValidDate = now + valid
+
+        elif not self.valid:  # DAY
+            order.TimeRestriction = self._otrestriction[Order.T_Day]
 
-        # Support for custom user arguments
-        for k in kwargs:
-            if hasattr(order, k):
-                setattr(order, k, kwargs[k])
+        # Support for custom user arguments. Only unknown names need probing
+        order_fields = self._order_fields
+        for k, v in kwargs.items():
+            if k in order_fields or hasattr(order, k):
+                setattr(order, k, v)
 
         return order
 
+    def _return_vcorder(self, vcorder):
+        # Keep the ComTrader order object for reuse in this thread
+        try:
+            pool = self._order_pool.pool
+        except AttributeError:
+            pool = self._order_pool.pool = []
+
+        if len(pool) < self._VCORDER_POOL:
+            pool.append(vcorder)
+
+    def _t_submit(self):
+        # Sends the queued orders. Running in its own thread with its own
+        # Trader object lets the strategy queue several orders without
+        # waiting for the COM round trip of each one
+        store = self.store
+        coinit, vcct = False, None
+        try:
+            store.comtypes.CoInitialize()  # running in another thread
+            coinit = True
+            vcct = store.CreateObject(store.vcctmod.Trader)
+        except Exception as e:
+            store.put_notification(e)
+            self._submitting = False  # submit rejects from now on
+
+        while True:
+            msg = self._submit_q.get()
+            if msg is None:
+                break  # broker has been stopped
+
+            order, args, validdate = msg
+            if vcct is None:  # queued before the failure was known
+                self._reject(order)
+                continue
+
+            try:
+                oid = vcct.SendOrder(*args, ValidDate=validdate)
+            except Exception as e:
+                store.put_notification(e)
+                self._reject(order)
+                continue
+
+            order.vcorder = oid
+            with self._lock_orders:
+                self.orderbyid[oid] = order
+
+        if coinit:
+            store.comtypes.CoUninitialize()
+
+    def _reject(self, order):
+        order.reject(self)
+        self.notify(order)
+
     def submit(self, order, vcorder):
+        if not self._submitting:  # orders cannot be sent
+            self._return_vcorder(vcorder)
+            self._reject(order)
+            return order
+
         order.submit(self)
+        order._signmul = -1 if order.issell() else 1  # sign for executions
 
+        # Extract the values here: the ComTrader order object belongs to this
+        # thread and goes back to the pool
         vco = vcorder
-        oid = self.store.vcct.SendOrder(
+        args = (
             vco.Account, vco.SymbolCode,
             vco.OrderType, vco.OrderSide, vco.Volume, vco.Price, vco.StopPrice,
             vco.VolumeRestriction, vco.TimeRestriction,
-            ValidDate=vco.ValidDate
         )
+        validdate = vco.ValidDate
+        self._return_vcorder(vco)
 
-        order.vcorder = oid
         order.addcomminfo(self.getcommissioninfo(order.data))
 
-        with self._lock_orders:
-            self.orderbyid[oid] = order
-        self.notify(order)
+        self.notify(order)  # before sending: events may follow right away
+        self._submit_q.put((order, args, validdate))  # sent in _t_submit
         return order
 
     def buy(self, owner, data,
@@ -344,6 +523,11 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
     #
     # COM Events implementation
     #
+    # comtypes resolves the handlers below by name only once, when the sink
+    # is connected with GetEvents, and keeps the bound methods in the vtable
+    # of the event receiver. Events are therefore dispatched without a name
+    # lookup and the names have to be kept as they are
+    #
     def __call__(self, trader):
         # Called to start the process, call in sub-thread. only the passed
         # trader can be used in the thread
@@ -354,6 +538,7 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
                 self.startingcash = self.cash = acc.Balance.Cash
                 self.startingvalue = self.value = acc.Balance.NetWorth
                 self._acc_name = acc.Account
+                self._acc_obj = acc
                 break  # found the account
 
         return self
@@ -362,12 +547,10 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
         if self._acc_name is None or self._acc_name != Account:
             return  # skip notifs for other accounts
 
-        for acc in self.trader.Accounts:
-            if acc.Account == Account:
-                # Update store values
-                self.cash = acc.Balance.Cash
-                self.value = acc.Balance.NetWorth
-                break
+        # Update store values from the account located in __call__
+        balance = self._acc_obj.Balance
+        self.cash = balance.Cash
+        self.value = balance.NetWorth
 
     def OnModifiedOrder(self, Order):
         # We are not expecting this: unless backtrader starts implementing
@@ -375,11 +558,9 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
         pass
 
     def OnCancelledOrder(self, Order):
-        with self._lock_orders:
-            try:
-                border = self.orderbyid[Order.OrderId]
-            except KeyError:
-                return  # possibly external order
+        border = self.orderbyid.get(Order.OrderId)  # lock-free read
+        if border is None:
+            return  # possibly external order
 
         border.cancel()
         self.notify(border)
@@ -391,16 +572,12 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
         self.OnExecutedOrder(Order, partial=True)
 
     def OnExecutedOrder(self, Order, partial):
-        with self._lock_orders:
-            try:
-                border = self.orderbyid[Order.OrderId]
-            except KeyError:
-                return  # possibly external order
+        border = self.orderbyid.get(Order.OrderId)  # lock-free read
+        if border is None:
+            return  # possibly external order
 
         price = Order.Price
-        size = Order.Volume
-        if border.issell():
-            size *= -1
+        size = Order.Volume * border._signmul
 
         # Find position and do a real update - accounting happens here
         position = self.getposition(border.data, clone=False)
@@ -408,18 +585,22 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
         psize, pprice, opened, closed = position.update(size, price)
 
         comminfo = border.comminfo
-        closedvalue = comminfo.getoperationcost(closed, pprice_orig)
-        closedcomm = comminfo.getcommission(closed, price)
+        getopcost = comminfo.getoperationcost  # used twice below
+        getcomm = comminfo.getcommission
 
-        openedvalue = comminfo.getoperationcost(opened, price)
-        openedcomm = comminfo.getcommission(opened, price)
+        closedvalue = getopcost(closed, pprice_orig)
+        closedcomm = getcomm(closed, price)
+
+        openedvalue = getopcost(opened, price)
+        openedcomm = getcomm(opened, price)
 
         pnl = comminfo.profitandloss(-closed, pprice_orig, price)
         margin = comminfo.getvaluesize(size, price)
 
         # NOTE: No commission information available in the Trader interface
         # CHECK: Use reported time instead of last data time?
-        border.execute(border.data.datetime[0],
+        dt = border.data.datetime[0]
+        border.execute(dt,
                        size, price,
                        closed, closedvalue, closedcomm,
                        opened, openedvalue, openedcomm,
@@ -435,11 +616,9 @@ class VCBroker(with_metaclass(MetaVCBroker, BrokerBase)):
 
     def OnOrderInMarket(self, Order):
         # Other is in ther market ... therefore "accepted"
-        with self._lock_orders:
-            try:
-                border = self.orderbyid[Order.OrderId]
-            except KeyError:
-                return  # possibly external order
+        border = self.orderbyid.get(Order.OrderId)  # lock-free read
+        if border is None:
+            return  # possibly external order
 
         border.accept()
         self.notify(border)